@@ -1,5 +1,7 @@
+import heapq
+import math
 import sys
-from queue import SimpleQueue
+from collections import Counter, deque
 
 from crossword import *
 
@@ -16,6 +18,40 @@ class CrosswordCreator():
             for var in self.crossword.variables
         }
 
+        # The puzzle's shape never changes, so count its variables and look
+        # up their neighbors only once
+        self.variable_count = len(self.crossword.variables)
+        self.neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.crossword.variables
+        }
+
+        # Static tie-breaker for ordering values: the log of how common each
+        # of a word's letters is at its position among words of its length,
+        # so rarer words come first
+        lengths = {var.length for var in self.crossword.variables}
+        frequencies = Counter(
+            (len(word), index, letter)
+            for word in self.crossword.words
+            if (len(word) in lengths)
+            for index, letter in enumerate(word)
+        )
+        self.word_scores = {
+            word: sum(
+                math.log(frequencies[len(word), index, letter])
+                for index, letter in enumerate(word)
+            )
+            for word in self.crossword.words
+            if (len(word) in lengths)
+        }
+
+        # Cached results of `letter_counts`, keyed by (variable, index)
+        self.letter_count_cache = dict()
+
+        # For each variable, the assigned variables whose forward checks
+        # pruned its domain, in the order the pruning happened
+        self.pruned_by = {var: [] for var in self.crossword.variables}
+
     def letter_grid(self, assignment):
         """
         Return 2D array representing a given assignment.
@@ -25,18 +61,21 @@ class CrosswordCreator():
             for _ in range(self.crossword.height)
         ]
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            if (variable.direction == Variable.ACROSS):
+                j = variable.j
+                letters[variable.i][j:j + len(word)] = word
+            else:
+                for (i, j), letter in zip(variable.cells, word):
+                    letters[i][j] = letter
         return letters
 
-    def print(self, assignment):
+    def print(self, assignment, letters=None):
         """
         Print crossword assignment to the terminal.
+        `letters` is the assignment's `letter_grid`, computed if not given.
         """
-        letters = self.letter_grid(assignment)
+        if (letters is None):
+            letters = self.letter_grid(assignment)
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
@@ -45,15 +84,17 @@ class CrosswordCreator():
                     print("█", end="")
             print()
 
-    def save(self, assignment, filename):
+    def save(self, assignment, filename, letters=None):
         """
         Save crossword assignment to an image file.
+        `letters` is the assignment's `letter_grid`, computed if not given.
         """
         from PIL import Image, ImageDraw, ImageFont
         cell_size = 100
         cell_border = 2
         interior_size = cell_size - 2 * cell_border
-        letters = self.letter_grid(assignment)
+        if (letters is None):
+            letters = self.letter_grid(assignment)
 
         # Create a blank canvas
         img = Image.new(
@@ -65,6 +106,10 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # The grid only holds a handful of distinct letters, so measure each
+        # of them once rather than once per cell
+        sizes = dict()
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
@@ -77,7 +122,11 @@ class CrosswordCreator():
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
                     if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
+                        if letters[i][j] not in sizes:
+                            sizes[letters[i][j]] = draw.textsize(
+                                letters[i][j], font=font
+                            )
+                        w, h = sizes[letters[i][j]]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
@@ -100,13 +149,10 @@ class CrosswordCreator():
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
         """
-        for i in self.domains.keys():
-            lst = []
-            for word in self.domains[i]:
-                if (len(word) != i.length):
-                    lst.append(word)
-            for word in lst:
-                self.domains[i].remove(word)
+        self.domains = {
+            var: {word for word in words if len(word) == var.length}
+            for var, words in self.domains.items()
+        }
 
     def revise(self, x, y):
         """
@@ -117,16 +163,22 @@ class CrosswordCreator():
         Return True if a revision was made to the domain of `x`; return
         False if no revision was made.
         """
-        revised = False
         overlap = self.crossword.overlaps[x, y]
-        if (overlap is not None):
-            for word1 in self.domains[x]:
-                for word2 in self.domains[y]:
-                    if (word1[overlap[0]] != word2[overlap[1]]):
-                        self.domains.remove(word1)
-                        revised = True
-                        break
-        return revised
+        if (overlap is None):
+            return False
+
+        # A word for `x` has a match in `y` iff some word for `y` has the
+        # same letter at the overlap, so only the set of letters matters
+        letters = {word[overlap[1]] for word in self.domains[y]}
+        index = overlap[0]
+        domain = {
+            word for word in self.domains[x]
+            if word[index] in letters
+        }
+        if (len(domain) == len(self.domains[x])):
+            return False
+        self.domains[x] = domain
+        return True
 
 
     def ac3(self, arcs=None):
@@ -138,23 +190,35 @@ class CrosswordCreator():
         Return True if arc consistency is enforced and no domains are empty;
         return False if one or more domains end up empty.
         """
-        q = SimpleQueue()
+        neighbors = self.neighbors
+        domains = self.domains
+        revise = self.revise
+        queue = deque()
+        queued = set()
+
+        def push(arc):
+            if (arc not in queued):
+                queued.add(arc)
+                queue.append(arc)
+
         if (arcs is not None):
-            for i in arcs:
-                q.put(i)
+            for arc in arcs:
+                push(arc)
         else:
-            for i in self.crossword.variables:
-                for j in self.crossword.variables:
-                    if (i != j):
-                        q.put((i, j))
-        while not q.empty:
-            arc = q.get()
-            if (self.revise(arc[0], arc[1])):
-                if (len(self.domains[arc[0]]) == 0):
+            # Arcs between variables that do not overlap never revise anything
+            for x in self.crossword.variables:
+                for y in neighbors[x]:
+                    push((x, y))
+        while queue:
+            arc = queue.popleft()
+            queued.discard(arc)
+            x, y = arc
+            if (revise(x, y)):
+                if (len(domains[x]) == 0):
                     return False
-                for i in self.crossword.neighbors(arc[0]):
-                    if (i != arc[1]):
-                        q.put((i, arc[0]))
+                for z in neighbors[x]:
+                    if (z != y):
+                        push((z, x))
         return True
 
     def assignment_complete(self, assignment):
@@ -162,45 +226,95 @@ class CrosswordCreator():
         Return True if `assignment` is complete (i.e., assigns a value to each
         crossword variable); return False otherwise.
         """
-        for i in self.crossword.variables:
-            if (not assignment.get(i, 0)):
-                return False
-        return True
+        return len(assignment) == self.variable_count
 
     def consistent(self, assignment):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        for i in assignment.keys():
-            if (i.length != len(assignment[i])):
+        for i, word in assignment.items():
+            if (i.length != len(word)):
                 return False
-        for i in assignment.keys():
-            for j in assignment.keys():
+        overlaps = self.crossword.overlaps
+        for i, word1 in assignment.items():
+            for j, word2 in assignment.items():
                 if (i != j):
-                    overlap = self.crossword.overlaps[i, j]
+                    overlap = overlaps[i, j]
                     if (overlap is None):
                         continue
-                    if (assignment[i][overlap[0]] != assignment[j][overlap[1]]):
+                    if (word1[overlap[0]] != word2[overlap[1]]):
                         return False
-                    if (assignment[i] == assignment[j]):
+                    if (word1 == word2):
                         return False
         return True
 
-    def rules_out_values(self, var, word, neighbors, assignment):
-        count = 0
-        for i in neighbors:
-            if not assignment.get(i, 0):
-                for j in self.domains[i]:
-                    if (j == word):
-                        count += 1
-                        continue
-                    overlap = self.crossword.overlaps[i, var]
-                    if (overlap is None):
-                        continue
-                    if (word[overlap[1]] != j[overlap[0]]):
-                        count += 1
-        return count
+    def forward_check(self, var, assignment, conflict=None):
+        """
+        Remove values from the domains of the unassigned neighbors of `var`
+        that conflict with the word assigned to `var`.
+
+        Return a list of (variable, domain) pairs holding the domains as they
+        were before pruning, to be passed to `restore`. If a domain would end
+        up empty, leave `self.domains` unchanged and return None; in that case
+        the variables that had already pruned the emptied domain are added to
+        `conflict`, if given.
+        """
+        word = assignment[var]
+        overlaps = self.crossword.overlaps
+        domains = self.domains
+        pruned_by = self.pruned_by
+        trail = []
+        for neighbor in self.neighbors[var]:
+            if (neighbor in assignment):
+                continue
+            overlap = overlaps[var, neighbor]
+            index = overlap[1]
+            letter = word[overlap[0]]
+            old = domains[neighbor]
+            domain = {
+                value for value in old
+                if value[index] == letter and value != word
+            }
+            if (len(domain) == len(old)):
+                continue
+            if (len(domain) == 0):
+                if (conflict is not None):
+                    conflict.update(pruned_by[neighbor])
+                self.restore(trail)
+                return None
+            trail.append((neighbor, old))
+            domains[neighbor] = domain
+            pruned_by[neighbor].append(var)
+        return trail
+
+    def restore(self, trail):
+        """
+        Undo the domain changes recorded in `trail` by `forward_check`.
+        """
+        domains = self.domains
+        pruned_by = self.pruned_by
+        for var, domain in reversed(trail):
+            domains[var] = domain
+            pruned_by[var].pop()
+
+    def letter_counts(self, var, index):
+        """
+        Return a Counter of the letters at position `index` of the words in
+        the domain of `var`.
+
+        A result is reused while `self.domains[var]` is the same set of the
+        same size, which holds for the solver's own updates; it is only used
+        to order values, where a stale count cannot give a wrong answer.
+        """
+        domain = self.domains[var]
+        cached = self.letter_count_cache.get((var, index))
+        if (cached is not None and cached[0] is domain and
+                cached[1] == len(domain)):
+            return cached[2]
+        counts = Counter(word[index] for word in domain)
+        self.letter_count_cache[var, index] = (domain, len(domain), counts)
+        return counts
 
     def order_domain_values(self, var, assignment):
         """
@@ -209,11 +323,33 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        rules_out = []
-        for i in self.domains[var]:
-            rules_out.append((i, self.rules_out_values(var, i, self.crossword.neighbors(var), assignment)))
-        return [x[0] for x in sorted(rules_out, key = lambda i: i[1])]
-
+        # A value for `var` rules out exactly the neighbor values with a
+        # different letter at the overlap, so count each neighbor's letters
+        # once instead of comparing every pair of values
+        overlaps = self.crossword.overlaps
+        neighbor_letters = []
+        for neighbor in self.neighbors[var]:
+            if (neighbor in assignment):
+                continue
+            overlap = overlaps[var, neighbor]
+            neighbor_letters.append((
+                overlap[0],
+                len(self.domains[neighbor]),
+                self.letter_counts(neighbor, overlap[1])
+            ))
+
+        scores = self.word_scores
+
+        def rules_out(word):
+            return (
+                sum(
+                    size - letters[word[k]]
+                    for k, size, letters in neighbor_letters
+                ),
+                scores.get(word, 0)
+            )
+
+        return sorted(self.domains[var], key=rules_out)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -223,17 +359,42 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        unassigned_variables = []
-        for i in self.crossword.variables:
-            if (not assignment.get(i, 0)):
-                unassigned_variables.append((i, len(self.crossword.neighbors(i)), len(self.domains[i])))
-        unassigned_variables.sort(key = lambda x: x[2])
-        unassigned = []
-        for i in unassigned_variables:
-            if (i[2] != unassigned_variables[0][2]):
-                break
-            unassigned.append(i)
-        return max(unassigned, key = lambda x: x[1])[0]
+        neighbors = self.neighbors
+        return min(
+            (var for var in self.crossword.variables if var not in assignment),
+            key=lambda var: (len(self.domains[var]), -len(neighbors[var]))
+        )
+
+    def assign_next(self, var, values, assignment, used, conflict):
+        """
+        Assign to `var` the next word from the iterator `values` that is not
+        already used and survives forward checking.
+
+        `used` maps each assigned word to its variable and is updated with
+        the new word. The variables responsible for rejecting a word are
+        added to `conflict`.
+
+        Return the trail recorded by `forward_check`, or None (leaving `var`
+        unassigned) once `values` is exhausted.
+        """
+        for word in values:
+            if (word in used):
+                conflict.add(used[word])
+                continue
+            assignment[var] = word
+            trail = self.forward_check(var, assignment, conflict)
+            if (trail is not None):
+                used[word] = var
+                return trail
+            del assignment[var]
+        return None
+
+    def unassign(self, var, trail, assignment, used):
+        """
+        Undo an assignment made by `assign_next`.
+        """
+        self.restore(trail)
+        del used[assignment.pop(var)]
 
     def backtrack(self, assignment):
         """
@@ -242,20 +403,117 @@ class CrosswordCreator():
 
         `assignment` is a mapping from variables (keys) to words (values).
 
+        The domains of unassigned variables are kept forward-checked against
+        `assignment`, so a word taken from them only needs to be checked for
+        reuse elsewhere in the puzzle.
+
         If no assignment is possible, return None.
         """
-        if (self.assignment_complete(assignment)):
-            return assignment
-        start = self.select_unassigned_variable(assignment)
-        for i in self.order_domain_values(start, assignment):
-            assignment[start] = i
-            if (self.consistent(assignment)):
-                result = self.backtrack(assignment)
-                if (result != None):
-                    return result
-            del assignment[start]
-        return None
-                
+        used = {word: var for var, word in assignment.items()}
+        if (len(used) != len(assignment) or not self.consistent(assignment)):
+            return None
+
+        # Every domain change made by forward checking is undone before
+        # returning, so `self.domains` is left as it was and the creator can
+        # search again
+        trails = []
+        result = None
+        for var in assignment:
+            trail = self.forward_check(var, assignment)
+            if (trail is None):
+                break
+            trails.append(trail)
+        else:
+            frames = []
+            if (self.search(assignment, used, frames)):
+                result = assignment
+            trails.extend(trail for _, _, trail in frames)
+        for trail in reversed(trails):
+            self.restore(trail)
+        return result
+
+    def search(self, assignment, used, frames):
+        """
+        Extend `assignment`, whose words are the keys of `used` and whose
+        domains are already forward-checked, to a complete assignment.
+
+        The search runs on an explicit stack rather than by recursion,
+        kept in the list `frames`; each frame holds a variable, an iterator
+        over the values left to try for it, and the trail of the value it is
+        currently assigned. Return True once `assignment` is complete,
+        leaving the frames that made it so the caller can restore their
+        trails; return False, with every frame unassigned, if no complete
+        assignment exists.
+        """
+        depth = dict()
+
+        # Conflict-directed backjumping: for each variable on the stack,
+        # the earlier variables that caused any of its values to fail
+        conflicts = dict()
+
+        # Unassigned variables keyed as in `select_unassigned_variable`, by
+        # domain size and then highest degree; a variable is pushed again
+        # whenever its domain changes, and stale entries are skipped
+        heap = []
+        index = {var: k for k, var in enumerate(self.crossword.variables)}
+        domains = self.domains
+        neighbors = self.neighbors
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        assign_next = self.assign_next
+
+        def push(var):
+            heappush(heap, (
+                len(domains[var]), -len(neighbors[var]), index[var], var
+            ))
+
+        for var in self.crossword.variables:
+            if (var not in assignment):
+                push(var)
+
+        while (not self.assignment_complete(assignment)):
+            while True:
+                size, _, _, var = heappop(heap)
+                if (var not in assignment and size == len(domains[var])):
+                    break
+            values = iter(self.order_domain_values(var, assignment))
+            conflicts[var] = set()
+            trail = assign_next(var, values, assignment, used, conflicts[var])
+            while (trail is None):
+                push(var)
+
+                # Every value of `var` failed, because of the variables in its
+                # conflict set or those that pruned its domain, so jump back
+                # to the most recent of them; the variables in between had
+                # no part in the failure and trying their other values
+                # cannot help
+                conflict = conflicts.pop(var).union(self.pruned_by[var])
+                conflict.intersection_update(depth)
+                if (not conflict):
+                    while frames:
+                        var, _, trail = frames.pop()
+                        self.unassign(var, trail, assignment, used)
+                    return False
+                target = max(depth[v] for v in conflict)
+                while (len(frames) > target):
+                    var, values, trail = frames.pop()
+                    del depth[var]
+                    self.unassign(var, trail, assignment, used)
+                    push(var)
+                    for neighbor, _ in trail:
+                        push(neighbor)
+                    if (len(frames) > target):
+                        del conflicts[var]
+                conflict.discard(var)
+                conflicts[var].update(conflict)
+                trail = assign_next(
+                    var, values, assignment, used, conflicts[var]
+                )
+            for neighbor, _ in trail:
+                push(neighbor)
+            depth[var] = len(frames)
+            frames.append((var, values, trail))
+        return True
 
 
 def main():
@@ -278,9 +536,10 @@ def main():
     if assignment is None:
         print("No solution.")
     else:
-        creator.print(assignment)
+        letters = creator.letter_grid(assignment)
+        creator.print(assignment, letters)
         if output:
-            creator.save(assignment, output)
+            creator.save(assignment, output, letters)
 
 
 if __name__ == "__main__":